@@ -12,48 +12,27 @@ example given in the `Flask Extension Development
 __version__ = '0.3.0-dev'
 
 
-from threading import RLock
+from weakref import WeakKeyDictionary, WeakSet
 
+import cuttlepool
 from cuttlepool import CuttlePool, CuttlePoolError, PoolConnection
-from flask import current_app
+from flask import current_app, g, has_app_context
 
-try:
-    from cuttlepool import _CAPACITY, _OVERFLOW, _TIMEOUT
-except ImportError:
-    # Compatibility for cuttlepool-0.6.0
-    from cuttlepool import (CAPACITY as _CAPACITY, OVERFLOW as _OVERFLOW,
-                            TIMEOUT as _TIMEOUT)
+# cuttlepool-0.6.0 names its defaults without a leading underscore. The
+# unprefixed names are only looked up when the prefixed ones are missing, so
+# an incompatible cuttlepool fails at import.
+if hasattr(cuttlepool, '_CAPACITY'):
+    _CAPACITY = cuttlepool._CAPACITY
+    _OVERFLOW = cuttlepool._OVERFLOW
+    _TIMEOUT = cuttlepool._TIMEOUT
+else:
+    _CAPACITY = cuttlepool.CAPACITY
+    _OVERFLOW = cuttlepool.OVERFLOW
+    _TIMEOUT = cuttlepool.TIMEOUT
 
-# Find the stack on which we want to store the database connection.
-# Starting with Flask 0.9, the _app_ctx_stack is the correct one,
-# before that we need to use the _request_ctx_stack.
-try:
-    from flask import _app_ctx_stack as stack
-except ImportError:
-    from flask import _request_ctx_stack as stack
-
-
-def cuttlepool_factory(ping_fn, normalize_fn):
-    """
-    Creates a CuttlePool class.
-
-    :param ping_fn: A ping function to be called by the ping method.
-    :param normalize_fn: A normalize_connection function to be called by the
-        normalize_connection method.
-    """
-    class SQLPool(CuttlePool):
-        def ping(self, connection):
-            if ping_fn is not None:
-                return ping_fn(connection)
-            return super(SQLPool, self).ping(connection)
-
-        def normalize_connection(self, connection):
-            if normalize_fn is not None:
-                normalize_fn(connection)
-            else:
-                super(SQLPool, self).normalize_connection(connection)
-
-    return SQLPool
+# Prefix of the app.config options passed to the pool.
+_PREFIX = 'CUTTLEPOOL_'
+_PREFIX_LEN = len(_PREFIX)
 
 
 class FlaskCuttlePool(object):
@@ -72,6 +51,9 @@ class FlaskCuttlePool(object):
         connector.
     """
 
+    __slots__ = ('_connect', '_app', '_cuttlepool_kwargs', '_ping',
+                 '_normalize', '_pools', '_apps', '__weakref__')
+
     def __init__(self, connect, capacity=_CAPACITY, overflow=_OVERFLOW,
                  timeout=_TIMEOUT, app=None, **kwargs):
         self._connect = connect
@@ -81,57 +63,58 @@ class FlaskCuttlePool(object):
                                        overflow=overflow,
                                        timeout=timeout)
 
-        self._ping = self._normalize = self._CuttlePool = None
-        self._lock = RLock()    # Necessary for multithreaded apps.
+        self._ping = self._normalize = None
+        # Maps each app to its pool once the pool is made on first use.
+        self._pools = WeakKeyDictionary()
+        # The apps initialized with init_app().
+        self._apps = WeakSet()
 
         if app is not None:
             self.init_app(app)
 
     def init_app(self, app):
         """
-        Attaches a teardown handler to the ``app`` object.
+        Attaches an application context teardown handler to the ``app``
+        object and registers the extension in ``app.extensions``.
         """
-        # Use the newstyle teardown_appcontext if it's available,
-        # otherwise fall back to the request context.
-        if hasattr(app, 'teardown_appcontext'):
-            app.teardown_appcontext(self.teardown)
-        else:
-            app.teardown_request(self.teardown)
+        app.teardown_appcontext(self.teardown)
 
-        if not hasattr(app, 'extensions'):
-            app.extensions = {}
+        # Register the extension on the app. Pools are looked up through
+        # self._pools, not app.extensions.
+        extensions = app.extensions.setdefault('cuttlepool', [])
+        if self not in extensions:
+            extensions.append(self)
 
-        if 'cuttlepool' not in app.extensions:
-            app.extensions['cuttlepool'] = {}
-
-        app.extensions['cuttlepool'][id(self)] = None
+        self._apps.add(app)
 
     def _get_app(self):
         """
         Looks up the current application or the default passed to
         ``__init__()``
         """
-        if current_app:
+        try:
             app = current_app._get_current_object()
-        elif self._app is not None:
+        except RuntimeError:
+            # Outside of an application context.
             app = self._app
-        else:
-            raise RuntimeError('No application found.')
+            if app is None:
+                raise RuntimeError('No application found.')
 
-        if id(self) not in app.extensions['cuttlepool']:
+        if app not in self._apps:
             raise RuntimeError('This FlaskCuttlePool instance does not have '
                                'access to the current app. Initialize the app '
                                'on the instance with init_app().')
 
         return app
 
-    def _make_pool(self, app):
+    def _get_pool_kwargs(self, app):
         """
-        Make a CuttlePool instance. All configuration options on ``app.config``
-        of the form ``CUTTLEPOOL_<KEY>`` will be used as connection arguments
-        for the underlying driver. ``<KEY>`` will be converted to lowercase
-        such that ``app.config['CUTTLEPOOL_<KEY>'] = <value>`` will be passed
-        to the connection driver as ``<key>=<value>``.
+        Gets the keyword arguments used to make a CuttlePool instance. All
+        configuration options on ``app.config`` of the form
+        ``CUTTLEPOOL_<KEY>`` will be used as connection arguments for the
+        underlying driver. ``<KEY>`` will be converted to lowercase such that
+        ``app.config['CUTTLEPOOL_<KEY>'] = <value>`` will be passed to the
+        connection driver as ``<key>=<value>``.
 
         :param Flask app: A Flask ``app`` object.
 
@@ -144,18 +127,31 @@ class FlaskCuttlePool(object):
         # pool will connect to steakhouse instead.
         pool.init_app(app)
         """
-        prefix = 'CUTTLEPOOL_'
         kwargs = self._cuttlepool_kwargs.copy()
 
-        kwargs.update(
-            **{k[len(prefix):].lower(): v
-               for k, v in app.config.items()
-               if k.startswith(prefix)})
+        kwargs.update((k[_PREFIX_LEN:].lower(), v)
+                      for k, v in app.config.items()
+                      if k.startswith(_PREFIX))
 
-        if self._CuttlePool is None:
-            self._CuttlePool = cuttlepool_factory(self._ping, self._normalize)
+        return kwargs
 
-        return self._CuttlePool(self._connect, **kwargs)
+    def _make_pool(self, app):
+        """
+        Make a CuttlePool instance using the keyword arguments from
+        ``_get_pool_kwargs()``. Functions set with the ``ping`` and
+        ``normalize_connection`` decorators are attached directly to the
+        instance, replacing the ``CuttlePool`` methods.
+
+        :param Flask app: A Flask ``app`` object.
+        """
+        pool = CuttlePool(self._connect, **self._get_pool_kwargs(app))
+
+        if self._ping is not None:
+            pool.ping = self._ping
+        if self._normalize is not None:
+            pool.normalize_connection = self._normalize
+
+        return pool
 
     def commit(self):
         """
@@ -164,12 +160,13 @@ class FlaskCuttlePool(object):
         :raises RuntimeError: If there is no connection on the application
             context.
         """
-        ctx = stack.top
+        con = g.get('cuttlepool_connection') if has_app_context() else None
 
-        if hasattr(ctx, 'cuttlepool_connection'):
-            return ctx.cuttlepool_connection.commit()
+        if con is None:
+            raise RuntimeError("There's no connection on the application "
+                               "context.")
 
-        raise RuntimeError("There's no connection on the application context.")
+        return con.commit()
 
     def get_connection(self):
         """
@@ -186,14 +183,15 @@ class FlaskCuttlePool(object):
         """
         app = self._get_app()
 
-        with self._lock:
-            pool = app.extensions['cuttlepool'][id(self)]
+        pool = self._pools.get(app)
 
-            if pool is None:
-                pool = self._make_pool(app)
-                app.extensions['cuttlepool'][id(self)] = pool
+        if pool is None:
+            # setdefault() is atomic, so if threads race to make the pool
+            # they all get the same one. The extra, unused pools hold no
+            # connections and are simply discarded.
+            pool = self._pools.setdefault(app, self._make_pool(app))
 
-            return pool
+        return pool
 
     def ping(self, fn):
         """
@@ -222,34 +220,47 @@ class FlaskCuttlePool(object):
         Calls the ``PoolConnection``'s ``close()`` method, which puts the
         connection back in the pool.
         """
-        ctx = stack.top
+        # _cuttlepool_pinged doubles as the "pool used" mark. The connection
+        # property must set it on every path that stores a connection on
+        # the context, otherwise that connection won't be closed here.
+        if g.pop('_cuttlepool_pinged', None) is None:
+            return
 
-        if hasattr(ctx, 'cuttlepool_connection'):
-            ctx.cuttlepool_connection.close()
+        con = g.get('cuttlepool_connection')
+
+        if con is not None:
+            con.close()
 
     @property
     def connection(self):
         """
         Gets a ``PoolConnection`` object. Saves the connection on the
-        application context for subsequent gets.
+        application context for subsequent gets. The connection is pinged at
+        most once per application context.
 
         If there is no application context, returns ``None``.
         """
-        ctx = stack.top
+        if has_app_context():
+            con = g.get('cuttlepool_connection')
+
+            if con is not None and con._connection is not None:
+                # Skip the pool lookup and ping if this connection was
+                # already pinged on this context.
+                if g.get('_cuttlepool_pinged') == id(con):
+                    return con
 
-        if ctx is not None:
-            if not hasattr(ctx, 'cuttlepool_connection'):
-                ctx.cuttlepool_connection = self.get_connection()
+                if self.get_pool().ping(con):
+                    g._cuttlepool_pinged = id(con)
+                    return con
 
-            con = ctx.cuttlepool_connection
+                con.close()
 
-            pool = self.get_pool()
-            # Ensure connection is open.
-            if con._connection is None or not pool.ping(con):
-                ctx.cuttlepool_connection.close()
-                ctx.cuttlepool_connection = self.get_connection()
+            # The pool pings connections before handing them out, so a new
+            # connection doesn't need to be pinged again.
+            con = g.cuttlepool_connection = self.get_connection()
+            g._cuttlepool_pinged = id(con)
 
-            return ctx.cuttlepool_connection
+            return con
 
     @property
     def cursor(self):
@@ -30,7 +30,7 @@ setup(
     platforms='any',
     install_requires=[
         'cuttlepool>=0.6.0',
-        'flask'
+        'flask>=0.11'
     ],
     extras_require={
         'dev': ['pytest']
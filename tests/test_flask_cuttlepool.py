@@ -1,15 +1,7 @@
 # -*- coding: utf-8 -*-
 """Tests for Flask-CuttlePool."""
 import pytest
-from flask import Flask
-
-# Find the stack on which we want to store the database connection.
-# Starting with Flask 0.9, the _app_ctx_stack is the correct one,
-# before that we need to use the _request_ctx_stack.
-try:
-    from flask import _app_ctx_stack as stack
-except ImportError:
-    from flask import _request_ctx_stack as stack
+from flask import Flask, g
 
 import mocksql
 from flask_cuttlepool import (_CAPACITY, _OVERFLOW, _TIMEOUT, CuttlePool,
@@ -137,6 +129,7 @@ def test_init_no_app(user, password, host):
 def test_init_with_app(app, pool_one, user, password, host):
     """Test FlaskCuttlePool instantiates properly with an app object."""
     assert isinstance(pool_one, FlaskCuttlePool)
+    assert app.extensions['cuttlepool'] == [pool_one]
     assert pool_one._cuttlepool_kwargs['capacity'] == _CAPACITY
     assert pool_one._cuttlepool_kwargs['overflow'] == _OVERFLOW
     assert pool_one._cuttlepool_kwargs['timeout'] == _TIMEOUT
@@ -226,6 +219,19 @@ def test_make_pool(app, user, password, host):
     assert con_args['host'] == host
 
 
+def test_make_pool_config_after_init(app, pool_one):
+    """
+    Tests configuration set after the app is initialized is used by the
+    pool.
+    """
+    app.config['CUTTLEPOOL_DATABASE'] = 'steakhouse'
+
+    with app.app_context():
+        con_args = pool_one.get_pool().connection_arguments
+
+    assert con_args['database'] == 'steakhouse'
+
+
 def test_get_connection(app, pool_one):
     """Test get_connection returns a connection."""
     with app.app_context():
@@ -234,10 +240,10 @@ def test_get_connection(app, pool_one):
 
 
 def test_connection_app_ctx(app, pool_one):
-    """Tests the same connection is retrieved from the stack."""
+    """Tests the same connection is retrieved from ``g``."""
     with app.app_context():
         con1 = pool_one.connection
-        assert hasattr(stack.top, 'cuttlepool_connection')
+        assert 'cuttlepool_connection' in g
         con2 = pool_one.connection
         assert con1 is con2
 
@@ -253,6 +259,32 @@ def test_connection_after_close(app, pool_one):
         assert pool_one.connection.open
 
 
+def test_connection_pinged_once(app, pool_one):
+    """
+    Tests the connection is only pinged once per application context, including
+    when it's used through the cursor property.
+    """
+    pings = []
+
+    @pool_one.ping
+    def ping(con):
+        pings.append(con)
+        return True
+
+    with app.app_context():
+        con = pool_one.connection
+        num_pings = len(pings)
+        assert pool_one.connection is con
+        assert pool_one.connection is con
+        assert pool_one.cursor().connection is con._connection
+        assert pool_one.cursor().connection is con._connection
+        assert len(pings) == num_pings
+
+    with app.app_context():
+        pool_one.connection
+        assert len(pings) > num_pings
+
+
 def test_connection_multiple_app_ctx(app, pool_one):
     """
     Tests connection property saves a different connection to coexisting app
@@ -268,6 +300,33 @@ def test_connection_multiple_app_ctx(app, pool_one):
         assert con1 is pool_one.connection
 
 
+def test_teardown(app, pool_one):
+    """Tests the connection is closed when the application context ends."""
+    with app.app_context():
+        con = pool_one.connection
+
+    assert con._connection is None
+
+
+def test_teardown_pool_not_used(app, pool_one):
+    """
+    Tests teardown leaves the application context alone when the pool wasn't
+    used on it.
+    """
+    class SentinelConnection(object):
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    con = SentinelConnection()
+
+    with app.app_context():
+        g.cuttlepool_connection = con
+
+    assert not con.closed
+
+
 def test_commit(app, pool_one):
     """Tests the commit convenience method."""
     with app.app_context():